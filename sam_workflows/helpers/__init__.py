@@ -5,6 +5,7 @@ from .config import load_config
 from .convert import (
     pdf_frontpage_to_image,
     generate_jpgs,
+    existing_jpg,
     PDFConvertError,
     ImageConvertError,
 )
@@ -16,6 +17,7 @@ __all__ = [
     "upload_files",
     "pdf_frontpage_to_image",
     "generate_jpgs",
+    "existing_jpg",
     "PDFConvertError",
     "ImageConvertError",
     "load_config",
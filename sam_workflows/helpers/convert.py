@@ -1,12 +1,22 @@
+import os
 from os import environ as env
 from pathlib import Path
-from typing import Any, List, Dict, Optional
+from typing import Any, List, Dict, Optional, Sequence, Union
 
 import fitz
-from PIL import Image, ExifTags
+from PIL import Image
 
 from .watermark import add_watermark
 
+# Exif-tag with the orientation of the camera, cf. PIL.ExifTags.TAGS
+_ORIENTATION_TAG = 0x0112
+# Lossless transpositions that undo each rotated orientation
+_ORIENTATION_TRANSPOSE = {
+    3: Image.ROTATE_180,
+    6: Image.ROTATE_270,
+    8: Image.ROTATE_90,
+}
+
 # -----------------------------------------------------------------------------
 # Classes
 # -----------------------------------------------------------------------------
@@ -25,34 +35,106 @@ class ImageConvertError(Exception):
 # -----------------------------------------------------------------------------
 
 
-def pdf_frontpage_to_image(pdf_in: Path, out_folder: Path) -> Path:
+def pdf_frontpage_to_image(pdf_in: Path, size: int) -> Image.Image:
+    """Renders the first page of a pdf-file directly into memory, scaled so
+    that its longest side is the supplied size.
+
+    Parameters
+    ----------
+    pdf_in : Path
+        The pdf-file to render
+    size : int
+        Width or height, whichever is largest, of the rendered page
+
+    Returns
+    ------
+    Image
+        PIL Image-object in RGB-mode
+    """
     if not pdf_in.is_file():
         raise FileNotFoundError(f"Input-path not a pdf-file: {pdf_in}")
 
-    # create if out_folder does not exist
-    out_folder.mkdir(parents=True, exist_ok=True)
-
     try:
         doc = fitz.open(pdf_in)
     except Exception as e:
         raise PDFConvertError(f"Unable to open {pdf_in} as pdf-file: {e}")
 
-    page = doc.loadPage(0)
-    pix = page.getPixmap()
-    out_file = str(out_folder / pdf_in.stem) + ".png"
-
     try:
-        pix.writePNG(out_file)
+        page = doc[0]
+        # Let MuPDF rasterize at the target size instead of downscaling later
+        scale = size / max(page.rect.width, page.rect.height)
+        pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False)
     except Exception as e:
-        raise PDFConvertError(f"Unable to save {pdf_in} as png-file: {e}")
-
-    return Path(out_file)
+        raise PDFConvertError(f"Unable to render {pdf_in}: {e}")
+    finally:
+        doc.close()
+
+    # frombytes() copies the samples, so the pixmap may outlive the document
+    return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+
+def _multi_thumb(img: Any, sizes: List[int]) -> Dict[int, Any]:
+    """Downscales the image to each of the supplied sizes, largest first, so
+    that every thumbnail is reduced from the previous one and not from the
+    full original. The supplied image is modified in-place.
+
+    Parameters
+    ----------
+    img : Image
+        PIL Image-object
+    sizes : List[int]
+        Maximum width and height of each thumbnail
+
+    Returns
+    ------
+    Dict[int, Image]
+        The thumbnail of each size
+    """
+
+    thumbs: Dict[int, Any] = {}
+    for size in sorted(set(sizes), reverse=True):
+        if thumbs:
+            img = img.copy()
+        # thumbnail() doesn't enlarge smaller img and keeps aspect-ratio.
+        # reducing_gap box-reduces by an integer factor before the Lanczos-
+        # filter, which then only runs on the reduced image.
+        img.thumbnail((size, size), resample=Image.LANCZOS, reducing_gap=2.0)
+        thumbs[size] = img
+    return thumbs
+
+
+def existing_jpg(
+    out_folder: Path, out_files: Sequence[Dict[str, Any]]
+) -> Optional[Path]:
+    """Finds the first access-file that has already been generated. Stops at
+    the first one, as callers only need to know whether any exists.
+
+    Parameters
+    ----------
+    out_folder : Path
+        Folder of the access-files
+    out_files : Sequence[Dict[str, Any]]
+        Size and filename of each access-file
+
+    Returns
+    ------
+    Optional[Path]
+        The path of the first existing access-file, or None
+    """
+
+    # Joined as plain strings, as this runs for every file on re-runs
+    folder: str = os.path.join(out_folder, "")
+    for el in out_files:
+        out_file: str = folder + el["filename"]
+        if os.path.exists(out_file):
+            return Path(out_file)
+    return None
 
 
 def generate_jpgs(
-    img_in: Path,
+    img_in: Union[Path, Image.Image],
     out_folder: Path,
-    out_files: List[Dict[str, Any]] = [
+    out_files: Sequence[Dict[str, Any]] = (
         {
             "size": 1920,
             "filename": "large.jpg",
@@ -65,73 +147,70 @@ def generate_jpgs(
             "size": 150,
             "filename": "small.jpg",
         },
-    ],
+    ),
     quality: int = 80,
     watermark: bool = False,
     overwrite: bool = False,
 ) -> Dict[int, Path]:
 
     out_folder.mkdir(parents=True, exist_ok=True)
+    folder: str = os.path.join(out_folder, "")
 
     if watermark:
         WATERMARK_WIDTH = int(env["SAM_WATERMARK_WIDTH"])
-    try:
-        img: Any = Image.open(img_in)
-    except Exception as e:
-        raise ImageConvertError(f"Error opening file {img_in.name}: {e}")
 
     # Key-value pairs of the size and path of each accessfile
     resp: Dict[int, Path] = {}
-    img.load()
+    sizes: List[int] = [el["size"] for el in out_files]
+
+    # Skip conversion, if overwrite is False and a file already exists.
+    # Checked before the image is opened, as this is the common re-run case.
+    if not overwrite:
+        existing: Optional[Path] = existing_jpg(out_folder, out_files)
+        if existing is not None:
+            raise FileExistsError(f"File already exists: {existing}")
+
+    # Already loaded images, e.g. rendered pdf-pages, are used as is
+    if isinstance(img_in, Image.Image):
+        img: Any = img_in
+    else:
+        try:
+            img = Image.open(img_in)
+        except Exception as e:
+            raise ImageConvertError(f"Error opening file {img_in.name}: {e}")
 
-    # JPG image might be rotated. Fix, if rotatet.
-    if hasattr(img, "_getexif"):  # only present in JPGs
-        # Find the orientation exif tag.
-        orientation_key: Optional[int] = None
-        for tag, tag_value in ExifTags.TAGS.items():
-            if tag_value == "Orientation":
-                orientation_key = tag
-                break
-
-        # If exif data is present, rotate image according to
-        # orientation value.
-        if img.getexif() is not None:
-            exif: Dict[Any, Any] = dict(img.getexif().items())
-            orientation: Optional[int] = exif.get(orientation_key)
-            if orientation == 3:
-                img = img.rotate(180)
-            elif orientation == 6:
-                img = img.rotate(270)
-            elif orientation == 8:
-                img = img.rotate(90)
-
-    # for size, extension in sizes.items():
-    for el in out_files:
-        size: int = el.get("size", "")
-        copy_img = img.copy()
-        # thumbnail() doesn't enlarge smaller img and keeps aspect-ratio
-        copy_img.thumbnail((size, size))
+        # Let libjpeg decode at a reduced scale. No-op for other formats.
+        img.draft("RGB", (max(sizes) * 2, max(sizes) * 2))
+        img.load()
 
-        # If larger than watermark-width, add watermark
-        if watermark and (copy_img.width > WATERMARK_WIDTH):
-            copy_img = add_watermark(copy_img)
+    # JPG image might be rotated. Fix, if rotatet.
+    orientation: int = img.getexif().get(_ORIENTATION_TAG, 1)
+    if orientation in _ORIENTATION_TRANSPOSE:
+        img = img.transpose(_ORIENTATION_TRANSPOSE[orientation])
 
-        # If not rbg, convert before saving as jpg
-        if copy_img.mode != "RGB":
-            copy_img = copy_img.convert("RGB")
+    # If not rbg, convert once before resizing and saving as jpg
+    if img.mode != "RGB":
+        img = img.convert("RGB")
 
-        out_path: Path = out_folder / el["filename"]
+    thumbs: Dict[int, Any] = _multi_thumb(img, sizes)
 
-        # Skip saving, if overwrite is False and file already exists
-        if out_path.exists() and not overwrite:
-            raise FileExistsError(f"File already exists: {out_path}")
+    # If larger than watermark-width, add watermark. Each thumbnail is its
+    # own image and all are reduced already, so no copy is needed. Sizes
+    # listed more than once share a thumbnail, which is watermarked once.
+    if watermark:
+        for thumb in thumbs.values():
+            if thumb.width > WATERMARK_WIDTH:
+                add_watermark(thumb, inplace=True)
 
+    for el in out_files:
+        size: int = el["size"]
+        out_file: str = folder + el["filename"]
         try:
-            copy_img.save(
-                out_path,
+            thumbs[size].save(
+                out_file,
                 quality=quality,
             )
-            resp[size] = out_path
+            resp[size] = Path(out_file)
         except Exception as e:
-            raise ImageConvertError(f"Error saving file {img_in.name}: {e}")
+            raise ImageConvertError(f"Error saving file {out_file}: {e}")
     return resp
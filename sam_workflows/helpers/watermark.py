@@ -1,15 +1,27 @@
+from functools import lru_cache
 from os import environ as env
 from pathlib import Path
-from PIL import Image
+from PIL import Image, ImageStat
 
 
-def add_watermark(img: Image) -> Image:
+@lru_cache(maxsize=None)
+def _load_logo(path: Path) -> Image:
+    """Loads a watermark-logo once per process."""
+    logo = Image.open(path)
+    logo.load()
+    return logo
+
+
+def add_watermark(img: Image, inplace: bool = False) -> Image:
     """Adds a ACA-watermark in the bottom-right corner of the supplied image.
 
     Parameters
     ----------
     img : Image
         PIL Image-object
+    inplace : bool
+        Paste the watermark onto the supplied image instead of a copy of it.
+        Defaults to False
 
     Returns
     ------
@@ -21,22 +33,26 @@ def add_watermark(img: Image) -> Image:
     WATERMARK_WHITE = Path.home() / env["APP_DIR"] / env["SAM_WATERMARK_WHITE"]
     WATERMARK_BLACK = Path.home() / env["APP_DIR"] / env["SAM_WATERMARK_BLACK"]
 
-    copy = img.copy()
-    grayscale = copy.convert("L")
+    copy = img if inplace else img.copy()
 
     anchor_x = copy.width - WATERMARK_WIDTH
     anchor_y = copy.height - WATERMARK_HEIGHT
-    pixel_count = WATERMARK_WIDTH * WATERMARK_HEIGHT
-    pixel_values = 0
-
-    for x in range(anchor_x, anchor_x + WATERMARK_WIDTH):
-        for y in range(anchor_y, anchor_y + WATERMARK_HEIGHT):
-            pixel_values = pixel_values + grayscale.getpixel((x, y))
 
-    if pixel_values / pixel_count < 128:
-        logo = Image.open(WATERMARK_WHITE)
+    # Mean brightness of the area to put the watermark on
+    area = copy.crop(
+        (
+            anchor_x,
+            anchor_y,
+            anchor_x + WATERMARK_WIDTH,
+            anchor_y + WATERMARK_HEIGHT,
+        )
+    )
+    brightness: float = ImageStat.Stat(area.convert("L")).mean[0]
+
+    if brightness < 128:
+        logo = _load_logo(WATERMARK_WHITE)
     else:
-        logo = Image.open(WATERMARK_BLACK)
+        logo = _load_logo(WATERMARK_BLACK)
 
     copy.paste(logo, (anchor_x, anchor_y), logo)
 
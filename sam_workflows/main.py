@@ -1,6 +1,7 @@
 import codecs
 import sys
 import asyncio
+import multiprocessing
 from pathlib import Path
 
 from gooey import Gooey, GooeyParser
@@ -101,5 +102,7 @@ async def main() -> None:
 
 
 if __name__ == "__main__":
+    # Needed by the conversion worker-processes in the pyinstaller-build
+    multiprocessing.freeze_support()
     loop = asyncio.get_event_loop()
     loop.run_until_complete(main())
@@ -1,7 +1,14 @@
+import asyncio
 import json
+import logging
+import os
 import shutil
+import stat
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from os import environ as env
-from typing import List, Dict
+from typing import Any, List, Dict, Optional, Tuple
 from pathlib import Path
 
 from sam_workflows.acastorage.exceptions import UploadError
@@ -14,14 +21,256 @@ from ..helpers import (
     upload_files,
     pdf_frontpage_to_image,
     generate_jpgs,
+    existing_jpg,
     ImageConvertError,
 )
 
+# Number of converted files to upload concurrently
+UPLOAD_BATCH_SIZE = 16
+
+logger = logging.getLogger("sam_workflows")
+
 # -----------------------------------------------------------------------------
 # Functions
 # -----------------------------------------------------------------------------
 
 
+def _init_logger() -> None:
+    """Logs to stdout, which is shown in the Gooey-console. Also run in each
+    worker-process, as they do not inherit the handler when spawned.
+    """
+
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler(sys.stdout))
+        logger.setLevel(logging.INFO)
+
+
+def _first_int(status: str) -> int:
+    """Parses the leading number of a SAM-status, e.g. 1 from
+    "1;Ingen andre juridiske begrænsninger".
+    """
+
+    return int(status.partition(";")[0])
+
+
+def _load_metadata(row: Dict[str, str]) -> Optional[Dict[str, str]]:
+    """Parses the SAM-metadata of a row from the csv-file and checks the
+    rights of the file. Only the fields needed for conversion are kept, so
+    that rows which are skipped never reach the worker-processes.
+
+    Returns
+    ------
+    Optional[Dict[str, str]]
+        The id and filename of the file, or None if the file may not be
+        published or its metadata is malformed.
+    """
+
+    try:
+        data = json.loads(row["oasDataJsonEncoded"])
+        legal_status = _first_int(data.get("other_restrictions", "4"))
+        constractual_status = _first_int(data.get("contractual_status", "1"))
+        filename: str = data["filename"]
+    except (ValueError, KeyError, AttributeError, TypeError) as e:
+        logger.info(
+            f"Skipping {row['uniqueID']} due to malformed metadata: {e}"
+        )
+        return None
+
+    # Check rights
+    if legal_status > 1:
+        logger.info(f"Skipping {filename} due to legal restrictions")
+        return None
+    if constractual_status < 3:
+        logger.info(f"Skipping {filename} due to contractual restrictions")
+        return None
+
+    return {"file_id": row["uniqueID"], "filename": filename}
+
+
+def _process_one(
+    metadata: Dict[str, str],
+    idx: int,
+    *,
+    files_count: int,
+    master_path: Path,
+    access_path: Path,
+    image_formats: List[str],
+    image_files: Tuple[Tuple[int, str], ...],
+    pdf_files: Tuple[Tuple[int, str], ...],
+    watermark: bool,
+    overwrite: bool,
+) -> Optional[Dict[str, Any]]:
+    """Checks the masterfile of a single row from the csv-file and generates
+    its access-files. Runs in a worker-process.
+
+    The access-files to generate for images and pdf-files are given as their
+    size and filename-suffix, largest first.
+
+    Returns
+    ------
+    Optional[Dict[str, Any]]
+        The id, filename, record_type and generated jpgs of the row, or None
+        if the row was skipped or failed.
+    """
+
+    file_id: str = metadata["file_id"]
+    filename: str = metadata["filename"]
+    logger.info(f"Processing {filename} ({idx} of {files_count})")
+
+    # filepath
+    filepath = master_path / filename
+    try:
+        filestat = os.stat(filepath)
+    except OSError:
+        logger.info(f"No file found at: {filepath}")
+        return None
+    if not stat.S_ISREG(filestat.st_mode):
+        logger.info(f"Filepath refers to a directory: {filepath}")
+        return None
+
+    # If pdf-file
+    if filepath.suffix == ".pdf":
+        record_type = "web_document"
+        access_files = pdf_files
+    # elif image-file
+    elif filepath.suffix in image_formats:
+        record_type = "image"
+        access_files = image_files
+    else:
+        logger.info(f"Unable to handle fileformat: {filename}")
+        return None
+
+    out_folder = access_path / file_id
+    output_files = [
+        {"size": size, "filename": f"{file_id}{suffix}"}
+        for size, suffix in access_files
+    ]
+
+    # Skip before copying, rendering or decoding anything, if overwrite is
+    # False and any access-file already exists
+    if not overwrite and existing_jpg(out_folder, output_files) is not None:
+        logger.info(
+            f"Skipping conversion. Access-files already exist: {filename}"
+        )
+        return None
+
+    # ensure access-folder for this files access-copies
+    out_folder.mkdir(exist_ok=True)
+
+    if record_type == "web_document":
+        # copy pdf to relevant sub-access-dir
+        shutil.copy2(filepath, out_folder / f"{file_id}_c.pdf")
+
+        # render first page in pdf-file at the largest access-size
+        try:
+            source: Any = pdf_frontpage_to_image(filepath, pdf_files[0][0])
+        except PDFConvertError as e:
+            logger.info(f"Error converting pdf: {e}")
+            return None
+    else:
+        source = filepath
+
+    # Generate access-files
+    try:
+        jpgs = generate_jpgs(
+            source,
+            out_folder=out_folder,
+            out_files=output_files,
+            watermark=watermark,
+            # Existing access-files were checked above
+            overwrite=True,
+        )
+    except FileNotFoundError as e:
+        logger.info(f"Failed conversion. File not found: {e}")
+    except ImageConvertError as e:
+        logger.info(f"Failed to generate jpgs from {filename}: {e}")
+    else:
+        logger.info(f"Successfully converted {filename}")
+        return {
+            "file_id": file_id,
+            "filename": filename,
+            "record_type": record_type,
+            "jpgs": jpgs,
+        }
+    return None
+
+
+def _filedata(
+    result: Dict[str, Any],
+    columns: Dict[int, str],
+    acastorage_url: Optional[str] = None,
+) -> Dict[str, str]:
+    """Builds the row to re-import into SAM for a converted file. The row
+    links to the uploaded files, if acastorage_url is given, else to the
+    local access-files.
+    """
+
+    file_id: str = result["file_id"]
+    jpgs: Dict[int, Path] = result["jpgs"]
+    filedata = {
+        "oasid": file_id,
+        "record_type": result["record_type"],
+    }
+    for size, path in jpgs.items():
+        if acastorage_url:
+            filedata[columns[size]] = "/".join(
+                [acastorage_url, file_id, path.name]
+            )
+        else:
+            filedata[columns[size]] = str(path)
+
+    if acastorage_url and result["record_type"] == "web_document":
+        filedata["web_document_url"] = "/".join(
+            [acastorage_url, file_id, f"{file_id}_c.pdf"]
+        )
+    return filedata
+
+
+async def _upload(
+    result: Dict[str, Any], access_path: Path, overwrite: bool = False
+) -> bool:
+    """Uploads the access-files of a converted file to Azure.
+
+    Returns
+    ------
+    bool
+        Whether the access-files were uploaded
+    """
+
+    file_id: str = result["file_id"]
+    filename: str = result["filename"]
+    filepaths: List[Dict[str, Path]] = []
+    for path in result["jpgs"].values():
+        filepaths.append(
+            {
+                "filepath": path,
+                "dest_dir": Path(file_id),
+            }
+        )
+    if result["record_type"] == "web_document":
+        filepaths.append(
+            {
+                "filepath": access_path / file_id / f"{file_id}_c.pdf",
+                "dest_dir": Path(file_id),
+            }
+        )
+    try:
+        await upload_files(filepaths, overwrite=overwrite)
+    except UploadError as e:
+        if not overwrite and "BlobAlreadyExists" in str(e):
+            logger.info(f"Skipping upload.{filename} already exists.")
+        else:
+            logger.info(f"Failed to upload {filename}: {e}")
+        return False
+    except Exception as e:
+        # E.g. auth- or connection-errors from the key-vault only fail the
+        # upload of this file, as errors in the worker-processes do
+        logger.info(f"Failed to upload {filename}: {e}")
+        return False
+    logger.info(f"Uploaded files for {filename}")
+    return True
+
+
 async def generate_sam_access_files(
     csv_in: Path,
     csv_out: Path,
@@ -32,6 +281,10 @@ async def generate_sam_access_files(
     """Generates, uploads and copies access-images from the files in the
     csv-file.
 
+    The access-images are generated in a pool of worker-processes, while the
+    converted files are uploaded from the event-loop in batches of
+    UPLOAD_BATCH_SIZE.
+
     Parameters
     ----------
     csv_in : Path
@@ -82,7 +335,6 @@ async def generate_sam_access_files(
             / "testfiles"
         )
 
-    TEMP_PATH = Path.home() / env["APP_DIR"] / "temp"  # Used for pdf-files
     ACCESS_LARGE_SIZE = int(env["SAM_ACCESS_LARGE_SIZE"])
     ACCESS_MEDIUM_SIZE = int(env["SAM_ACCESS_MEDIUM_SIZE"])
     ACCESS_SMALL_SIZE = int(env["SAM_ACCESS_SMALL_SIZE"])
@@ -90,193 +342,117 @@ async def generate_sam_access_files(
     ACASTORAGE_URL = "/".join(
         [env["ACASTORAGE_ROOT"], env["ACASTORAGE_CONTAINER"]]
     )
+    # Size and filename-suffix of the access-files, largest first
+    IMAGE_FILES = (
+        (ACCESS_LARGE_SIZE, "_l.jpg"),
+        (ACCESS_MEDIUM_SIZE, "_m.jpg"),
+        (ACCESS_SMALL_SIZE, "_s.jpg"),
+    )
+    PDF_FILES = IMAGE_FILES[1:]
+
+    _init_logger()
 
     # Load csv-file from SAM
     files: List[Dict] = load_csv_from_sam(csv_in)
     files_count: int = len(files)
-    print(f"Csv-file loaded. {files_count} files to process.", flush=True)
+    logger.info(f"Csv-file loaded. {files_count} files to process.")
 
     output: List[Dict] = []
 
     # Ensure existence of access-folder
     ACCESS_PATH.mkdir(parents=True, exist_ok=True)
 
-    # Generate access-files
-    for idx, row in enumerate(files, start=1):
-        # Load SAM-metadata
-        file_id: str = row["uniqueID"]
-        data = json.loads(row["oasDataJsonEncoded"])
-        legal_status: str = data.get("other_restrictions", "4")
-        constractual_status: str = data.get("contractual_status", "1")
-        filename: str = data["filename"]
-        print(f"Processing {filename} ({idx} of {files_count})", flush=True)
-
-        # Check rights
-        if int(legal_status.split(";")[0]) > 1:
-            print(f"Skipping {filename} due to legal restrictions", flush=True)
-            continue
-        if int(constractual_status.split(";")[0]) < 3:
-            print(
-                f"Skipping {filename} due to contractual restrictions",
-                flush=True,
-            )
-            continue
-
-        # filepath
-        filepath = MASTER_PATH / filename
-        if not filepath.exists():
-            print(f"No file found at: {filepath}", flush=True)
-            continue
-        if not filepath.is_file():
-            print(f"Filepath refers to a directory: {filepath}", flush=True)
-            continue
-
-        # ensure access-folder for this files access-copies
-        Path(ACCESS_PATH / file_id).mkdir(exist_ok=True)
-
-        # Common access_files for all formats
-        output_files = [
-            {
-                "size": ACCESS_SMALL_SIZE,
-                "filename": f"{file_id}_s.jpg",
-            },
-            {
-                "size": ACCESS_MEDIUM_SIZE,
-                "filename": f"{file_id}_m.jpg",
-            },
-        ]
-        # If pdf-file
-        if filepath.suffix == ".pdf":
-            record_type = "web_document"
-            # copy pdf to relevant sub-access-dir
-            shutil.copy2(filepath, ACCESS_PATH / file_id / f"{file_id}_c.pdf")
-
-            # generate png-file from first page in pdf-file
-            TEMP_PATH.mkdir(exist_ok=True)
-            try:
-                filepath = pdf_frontpage_to_image(filepath, TEMP_PATH)
-            except PDFConvertError as e:
-                print(f"Error converting pdf: {e}", flush=True)
-                continue
-
-        # elif image-file
-        elif filepath.suffix in IMAGE_FORMATS:
-            record_type = "image"
-            output_files.append(
-                {
-                    "size": ACCESS_LARGE_SIZE,
-                    "filename": f"{file_id}_l.jpg",
-                }
-            )
+    process_one = partial(
+        _process_one,
+        files_count=files_count,
+        master_path=MASTER_PATH,
+        access_path=ACCESS_PATH,
+        image_formats=IMAGE_FORMATS,
+        image_files=IMAGE_FILES,
+        pdf_files=PDF_FILES,
+        watermark=watermark,
+        overwrite=overwrite,
+    )
 
-        else:
-            print(f"Unable to handle fileformat: {filename}", flush=True)
-            continue
+    # Csv-column of each size of access-files
+    columns: Dict[int, str] = {
+        ACCESS_SMALL_SIZE: "thumbnail",
+        ACCESS_MEDIUM_SIZE: "record_image",
+        ACCESS_LARGE_SIZE: "large_image",
+    }
+    loop = asyncio.get_event_loop()
+    queue: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue()
 
-        # Generate access-files
+    async def convert(executor: ProcessPoolExecutor) -> None:
+        conversions: List[Tuple[str, "asyncio.Future[Any]"]] = []
         try:
-            jpgs = generate_jpgs(
-                filepath,
-                out_folder=ACCESS_PATH / file_id,
-                out_files=output_files,
-                watermark=watermark,
-                overwrite=overwrite,
-            )
-        except FileNotFoundError as e:
-            print(f"Failed conversion. File not found: {e}", flush=True)
-        except FileExistsError as e:
-            print(f"Skipping conversion. File already exists: {e}", flush=True)
-        except ImageConvertError as e:
-            print(f"Failed to generate jpgs from {filename}: {e}", flush=True)
-        else:
-            print(f"Successfully converted {filename}", flush=True)
-
-            filedata = {
-                "oasid": file_id,
-                "record_type": record_type,
-            }
-            if jpgs.get(ACCESS_SMALL_SIZE):
-                filedata["thumbnail"] = str(jpgs[ACCESS_SMALL_SIZE])
-            if jpgs.get(ACCESS_MEDIUM_SIZE):
-                filedata["record_image"] = str(jpgs[ACCESS_MEDIUM_SIZE])
-            if jpgs.get(ACCESS_LARGE_SIZE):
-                filedata["large_image"] = str(jpgs[ACCESS_LARGE_SIZE])
-
-            # Upload access-files
-            if upload:
-                filepaths: List[Dict[str, Path]] = []
-                for path in jpgs.values():
-                    filepaths.append(
-                        {
-                            "filepath": path,
-                            "dest_dir": Path(file_id),
-                        }
-                    )
-                if record_type == "web_document":
-                    filepaths.append(
-                        {
-                            "filepath": ACCESS_PATH
-                            / file_id
-                            / f"{file_id}_c.pdf",
-                            "dest_dir": Path(file_id),
-                        }
+            for idx, row in enumerate(files, start=1):
+                metadata = _load_metadata(row)
+                if metadata is not None:
+                    conversions.append(
+                        (
+                            metadata["filename"],
+                            loop.run_in_executor(
+                                executor, process_one, metadata, idx
+                            ),
+                        )
                     )
+            for filename, conversion in conversions:
+                # Errors not handled in the worker only fail their own row
                 try:
-                    await upload_files(filepaths, overwrite=overwrite)
-                except UploadError as e:
-                    if not overwrite and "BlobAlreadyExists" in str(e):
-                        print(
-                            f"Skipping upload.{filename} already exists.",
-                            flush=True,
-                        )
-                    else:
-                        print(f"Failed to upload {filename}: {e}", flush=True)
+                    result = await conversion
+                except Exception as e:
+                    logger.info(
+                        f"Failed to generate jpgs from {filename}: {e}"
+                    )
+                    continue
+                if result is not None:
+                    await queue.put(result)
+        finally:
+            # Don't let the pool finish conversions nobody will collect
+            for _, conversion in conversions:
+                conversion.cancel()
+            # Signal that no more conversions are coming
+            await queue.put(None)
+
+    async def collect() -> None:
+        batch: List[Dict[str, Any]] = []
+        done = False
+        while not done:
+            result = await queue.get()
+            if result is None:
+                done = True
+            else:
+                batch.append(result)
+            if batch and (done or len(batch) == UPLOAD_BATCH_SIZE):
+                if upload:
+                    uploaded = await asyncio.gather(
+                        *[
+                            _upload(r, ACCESS_PATH, overwrite=overwrite)
+                            for r in batch
+                        ]
+                    )
                 else:
-                    print(f"Uploaded files for {filename}", flush=True)
-
-                    if record_type == "web_document":
-                        filedata["web_document_url"] = "/".join(
-                            [
-                                ACASTORAGE_URL,
-                                file_id,
-                                f"{file_id}_c.pdf",
-                            ]
-                        )
-                    if jpgs.get(ACCESS_SMALL_SIZE):
-                        filedata["thumbnail"] = "/".join(
-                            [
-                                ACASTORAGE_URL,
-                                file_id,
-                                jpgs[ACCESS_SMALL_SIZE].name,
-                            ]
-                        )
-                    if jpgs.get(ACCESS_MEDIUM_SIZE):
-                        filedata["record_image"] = "/".join(
-                            [
-                                ACASTORAGE_URL,
-                                file_id,
-                                jpgs[ACCESS_MEDIUM_SIZE].name,
-                            ]
-                        )
-                    if jpgs.get(ACCESS_LARGE_SIZE):
-                        filedata["large_image"] = "/".join(
-                            [
-                                ACASTORAGE_URL,
-                                file_id,
-                                jpgs[ACCESS_LARGE_SIZE].name,
-                            ]
+                    uploaded = [False] * len(batch)
+                for r, is_uploaded in zip(batch, uploaded):
+                    output.append(
+                        _filedata(
+                            r,
+                            columns,
+                            ACASTORAGE_URL if is_uploaded else None,
                         )
+                    )
+                batch = []
 
-            output.append(filedata)
+    # Generate access-files in the pool while uploading the converted ones
+    with ProcessPoolExecutor(initializer=_init_logger) as executor:
+        await asyncio.gather(convert(executor), collect())
 
     if output:
         save_csv_to_sam(output, csv_out)
-        print("Finished proccessing files", flush=True)
+        logger.info("Finished proccessing files")
 
         if len(output) < files_count:
-            print("One or more files were not processed", flush=True)
+            logger.info("One or more files were not processed")
     else:
-        print("No new accessfiles have been generated", flush=True)
-
-    if TEMP_PATH.exists():
-        shutil.rmtree(TEMP_PATH)
+        logger.info("No new accessfiles have been generated")